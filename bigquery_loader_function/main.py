@@ -1,20 +1,157 @@
+import json
 import os
+import time
+import perf
+from google.api_core import exceptions
 from google.cloud import bigquery
+from google.cloud import storage
 
+# --- CONFIGURATION ---
+DATASET_ID = "recipe_analytics"
+JOBS_PREFIX = "load_jobs"  # Outside 'backups/' so these records are not loaded
+MAX_ATTEMPTS = int(os.environ.get("LOAD_MAX_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = int(os.environ.get("LOAD_RETRY_BASE_SECONDS", "30"))
+SUBMIT_GRACE_SECONDS = 120  # A job may not be visible right after it is submitted
+RECORD_WRITE_ATTEMPTS = 5
 
-def load_to_bigquery(data, context):
+
+def table_name_for(file_name):
+    table_name = os.path.basename(file_name).replace(".csv", "")
+    if table_name == "recipe":
+        table_name = "recipes"
+    return table_name
+
+
+def load_job_config():
+    return bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.CSV,
+        skip_leading_rows=1,
+        autodetect=True,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+    )
+
+
+# --- LOAD JOB RECORDS ---
+# One JSON record per table at load_jobs/<table>.json:
+#   state:  running | retry | done | failed
+#   source: the file being loaded ({"uri", "generation"})
+#   job_id, location, attempt, submitted_at, next_attempt_at, error, output_rows
+#   queued: a newer file that arrived while a job was running or waiting to retry
+# Records are written with GCS generation preconditions, so concurrent loader
+# instances coalesce onto one record instead of racing truncating load jobs.
+#
+# BigQuery load URIs cannot pin an object generation, so a job loads whatever
+# version of the file is current when it runs. Generations are only used to
+# order events: a job submitted after generation N was written loads N or
+# newer. That is why every queued file gets a job of its own, even while the
+# table is backing off after a failure.
+
+
+def is_newer(source, other):
+    if not other:
+        return True
+    return int(source["generation"] or 0) > int(other["generation"] or 0)
+
+
+def running_record(record, source, attempt):
+    return {
+        "table": record["table"],
+        "table_id": record["table_id"],
+        "state": "running",
+        "source": source,
+        "attempt": attempt,
+        # Deterministic, so a duplicate submit is rejected by BigQuery
+        "job_id": f"load_{record['table']}_{source['generation']}_{attempt}",
+        "submitted_at": time.time(),
+        "queued": None,
+    }
+
+
+def read_record(bucket, table_name):
+    blob = bucket.blob(f"{JOBS_PREFIX}/{table_name}.json")
+    try:
+        record = json.loads(blob.download_as_text())
+    except exceptions.NotFound:
+        return blob, None, 0  # Generation 0 means "must not exist yet"
+    return blob, record, blob.generation
+
+
+def update_record(bucket, table_name, change):
+    """Read-modify-write of a table record.
+
+    `change` gets the current record (or None) and returns the new record, or
+    None to leave it untouched. Returns the new record, or None if unchanged.
+    """
+    for _ in range(RECORD_WRITE_ATTEMPTS):
+        blob, record, generation = read_record(bucket, table_name)
+        new_record = change(record)
+        if new_record is None:
+            return None
+        try:
+            blob.upload_from_string(
+                json.dumps(new_record),
+                content_type="application/json",
+                if_generation_match=generation,
+            )
+            return new_record
+        except exceptions.PreconditionFailed:
+            continue  # Another instance updated the record first; re-read it
+    raise RuntimeError(f"Could not update load record for {table_name}")
+
+
+def dataset_location(client, record):
+    """Location load jobs for the record's table run in (its dataset's)."""
+    return client.get_dataset(record["table_id"].rsplit(".", 1)[0]).location
+
+
+def submit_job(client, bucket, record):
+    """Submits the record's load job without waiting for it.
+
+    Saves the job's location in the record: outside the US / EU
+    multi-regions, the poller cannot look the job up without it.
+    """
+    with perf.span("bq_submit", job_id=record["job_id"]):
+        try:
+            job = client.load_table_from_uri(
+                record["source"]["uri"],
+                record["table_id"],
+                job_id=record["job_id"],
+                job_config=load_job_config(),
+            )
+            location = job.location
+        except exceptions.Conflict:
+            # Already submitted by an earlier delivery of this event
+            location = dataset_location(client, record)
+    print(f"📨 Submitted {record['job_id']} -> {record['table_id']} ({location})")
+
+    def save_location(current):
+        if current is None or current.get("job_id") != record["job_id"]:
+            return None  # Superseded by a newer job meanwhile
+        if current.get("location") == location:
+            return None
+        return {**current, "location": location}
+
+    update_record(bucket, record["table"], save_location)
+
+
+def load_to_bigquery(data, context, client=None, storage_client=None):
     """
     Gen 1 Cloud Function triggered by a change to a Cloud Storage bucket.
+
+    Submits a load job and returns straight away; `poll_load_jobs` confirms
+    the outcome. Files arriving while a job for the same table is running are
+    coalesced into a single follow-up load of the newest file.
+
     Args:
         data (dict): The Cloud Functions event payload.
         context (google.cloud.functions.Context): Metadata of triggering event.
+        client, storage_client: Optional clients (e.g. fakes in tests).
     """
     file_name = data["name"]
     bucket_name = data["bucket"]
 
     # Configuration
     PROJECT_ID = os.environ.get("GCP_PROJECT")
-    DATASET_ID = "recipe_analytics"
 
     # Only process files in the 'backups/' folder and CSVs
     if not file_name.startswith("backups/") or not file_name.endswith(".csv"):
@@ -22,31 +159,154 @@ def load_to_bigquery(data, context):
         return
 
     # Determine Table Name
-    table_name = os.path.basename(file_name).replace(".csv", "")
-    if table_name == "recipe":
-        table_name = "recipes"
-
+    table_name = table_name_for(file_name)
     table_id = f"{PROJECT_ID}.{DATASET_ID}.{table_name}"
-    uri = f"gs://{bucket_name}/{file_name}"
+    source = {
+        "uri": f"gs://{bucket_name}/{file_name}",
+        "generation": str(data.get("generation", "")),
+    }
 
     print(f"🚀 Processing {file_name} -> Loading into {table_id}...")
+    perf.new_context(entry_point="load_to_bigquery", file=file_name, table=table_id)
 
-    client = bigquery.Client()
+    bucket = (storage_client or storage.Client()).bucket(bucket_name)
 
-    job_config = bigquery.LoadJobConfig(
-        source_format=bigquery.SourceFormat.CSV,
-        skip_leading_rows=1,
-        autodetect=True,
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-    )
+    def claim(record):
+        if record and not is_newer(source, record["source"]):
+            return None  # Duplicate event, or an older file than already handled
+        if record and record["state"] in ("running", "retry"):
+            if not is_newer(source, record.get("queued")):
+                return None
+            return {**record, "queued": source}
+        return running_record(
+            {"table": table_name, "table_id": table_id}, source, attempt=1
+        )
 
-    try:
-        load_job = client.load_table_from_uri(uri, table_id, job_config=job_config)
-        load_job.result()  # Wait for job to complete
+    with perf.profile("load_to_bigquery"):
+        record = update_record(bucket, table_name, claim)
+        if record is None:
+            print(f"⏭️ {file_name} is already covered by a load of {table_id}.")
+            return
+        if record["queued"] == source:
+            print(f"🔗 Load of {table_id} in progress; queued {file_name} after it.")
+            return
+
+        try:
+            submit_job(client or bigquery.Client(), bucket, record)
+        except Exception as e:
+            # The record stays 'running'; the poller retries after the grace period.
+            print(f"❌ Error submitting load for {table_id}: {e}")
+
+
+# --- POLLER ---
+
+
+def report_success(record, job):
+    span = perf.Span("bq_job_wait", job_id=job.job_id, table=record["table_id"])
+    span.add(rows=job.output_rows or 0)
+    if job.created and job.ended:
+        span.duration = (job.ended - job.created).total_seconds()
+    span.emit()
+    print(f"✅ Loaded {job.output_rows} rows into {record['table_id']}.")
+
+
+def check_table(client, bucket, table_name):
+    """Advances one table's record and returns its new state."""
+    _, record, _ = read_record(bucket, table_name)
+    if record is None:
+        return "missing"
+    now = time.time()
+    job = None
+    error = None
+
+    if record["state"] == "running":
+        try:
+            # Records written before the job's location was saved look it up
+            location = record.get("location") or dataset_location(client, record)
+            job = client.get_job(record["job_id"], location=location)
+        except exceptions.NotFound:
+            if now - record["submitted_at"] < SUBMIT_GRACE_SECONDS:
+                return "running"
+            error = {"message": "Load job was never submitted"}
+        else:
+            if job.state != "DONE":
+                return "running"
+            error = job.error_result
+    elif record["state"] == "retry":
+        # A queued newer file does not wait for the old file's backoff
+        if now < record["next_attempt_at"] and not record["queued"]:
+            return "retry"
+    else:
+        return record["state"]
+
+    def advance(current):
+        if current is None or current.get("job_id") != record["job_id"]:
+            return None  # Another poller got here first
+        if current["state"] != record["state"]:
+            return None
+        if current["queued"]:
+            # A newer file is waiting; it supersedes this job's outcome.
+            return running_record(current, current["queued"], attempt=1)
+        if current["state"] == "retry":
+            return running_record(current, current["source"], current["attempt"] + 1)
+        if not error:
+            return {**current, "state": "done", "output_rows": job.output_rows}
+        if current["attempt"] >= MAX_ATTEMPTS:
+            return {**current, "state": "failed", "error": error}
+        delay = RETRY_BASE_SECONDS * 2 ** (current["attempt"] - 1)
+        return {
+            **current,
+            "state": "retry",
+            "error": error,
+            "next_attempt_at": now + delay,
+        }
+
+    new_record = update_record(bucket, table_name, advance)
+    if new_record is None:
+        return "running"
+
+    if job is not None and not error:
+        report_success(record, job)
+    elif error:
+        perf.log(
+            f"load failed {record['job_id']}",
+            severity="ERROR",
+            stage="bq_job_wait",
+            status="error",
+            job_id=record["job_id"],
+            table=record["table_id"],
+            attempt=record["attempt"],
+            error=error,
+        )
+        print(f"❌ Error loading {record['table_id']}: {error}")
+
+    if new_record["state"] == "running":
+        submit_job(client, bucket, new_record)
+    return new_record["state"]
+
+
+def poll_load_jobs(request, client=None, storage_client=None):
+    """
+    HTTP Cloud Function (run on a Cloud Scheduler cron) that confirms submitted
+    load jobs, reports row counts, retries failures with exponential backoff
+    and starts queued loads.
+    """
+    BUCKET_NAME = os.environ.get("BUCKET_NAME")
+    if not BUCKET_NAME:
+        return "Error: BUCKET_NAME env var missing.", 500
+
+    perf.new_context(entry_point="poll_load_jobs")
+    client = client or bigquery.Client()
+    bucket = (storage_client or storage.Client()).bucket(BUCKET_NAME)
 
-        table = client.get_table(table_id)
-        print(f"✅ Loaded {table.num_rows} rows into {table_id}.")
+    states = {}
+    with perf.profile("poll_load_jobs"):
+        for blob in bucket.list_blobs(prefix=f"{JOBS_PREFIX}/"):
+            table_name = os.path.basename(blob.name).replace(".json", "")
+            try:
+                states[table_name] = check_table(client, bucket, table_name)
+            except Exception as e:
+                print(f"❌ Error polling {table_name}: {e}")
+                states[table_name] = "error"
 
-    except Exception as e:
-        print(f"❌ Error loading {table_id}: {e}")
-        raise e
+    return json.dumps(states), 200
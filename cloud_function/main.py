@@ -1,28 +1,481 @@
 import functions_framework
 from google.cloud import firestore  # Use the direct client
 from google.cloud import storage
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+import contextvars
 import csv
 import io
+import json
 import os
+import perf
+import time
 
+# --- CONFIGURATION ---
+DATABASE_ID = "recipe"
+BACKUP_PREFIX = "backups"
+CHECKPOINT_PREFIX = "etl_runs"  # Outside 'backups/' so the BigQuery loader ignores it
+CURRENT_RUN_BLOB = f"{CHECKPOINT_PREFIX}/current_run"
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "500"))
+# Pages buffered per shard; the checkpoint is saved once per shard
+CHECKPOINT_EVERY_PAGES = int(os.environ.get("CHECKPOINT_EVERY_PAGES", "20"))
+COMPOSE_LIMIT = 32  # Max source objects per GCS compose request
+FANOUT_MAX_WORKERS = int(os.environ.get("FANOUT_MAX_WORKERS", "8"))
+FANOUT_SLICE_SECONDS = float(os.environ.get("FANOUT_SLICE_SECONDS", "60"))
+MIN_SLICE_SECONDS = 5  # Shorter slices spend most of their time checkpointing
+LOAD_JOBS_PREFIX = "load_jobs"  # JOBS_PREFIX of the BigQuery loader
+# Top-level folders a tenant prefix must not start with: anything under
+# 'backups/' is loaded into the shared BigQuery tables.
+RESERVED_PREFIXES = (BACKUP_PREFIX, CHECKPOINT_PREFIX, LOAD_JOBS_PREFIX)
 
-# Triggered by HTTP request
-@functions_framework.http
-def run_etl(request):
-    # 1. Configuration
-    BUCKET_NAME = os.environ.get("BUCKET_NAME")
-    PROJECT_ID = os.environ.get("GCP_PROJECT")  # Cloud Functions set this automatically
+# Output table -> (CSV file name, columns)
+OUTPUT_FILES = {
+    "users": ("users.csv", ["user_id", "username", "email", "created_at"]),
+    "recipes": (
+        "recipe.csv",
+        [
+            "recipe_id",
+            "title",
+            "author_id",
+            "prep_time_minutes",
+            "difficulty",
+            "created_at",
+        ],
+    ),
+    "ingredients": ("ingredients.csv", ["recipe_id", "name", "quantity", "unit"]),
+    "steps": ("steps.csv", ["recipe_id", "step_number", "instruction"]),
+    "interactions": (
+        "interactions.csv",
+        ["interaction_id", "user_id", "recipe_id", "type", "rating", "timestamp"],
+    ),
+}
+
+
+# --- TRANSFORMS (one Firestore document -> rows per output table) ---
+
+
+def transform_user(data):
+    return {
+        "users": [
+            {
+                "user_id": data.get("user_id"),
+                "username": data.get("username"),
+                "email": data.get("email"),
+                "created_at": str(data.get("created_at")),
+            }
+        ]
+    }
+
+
+def transform_recipe(data):
+    r_id = data.get("recipe_id")
+    return {
+        "recipes": [
+            {
+                "recipe_id": r_id,
+                "title": data.get("title"),
+                "author_id": data.get("author_id"),
+                "prep_time_minutes": data.get("prep_time_minutes"),
+                "difficulty": data.get("difficulty"),
+                "created_at": str(data.get("created_at")),
+            }
+        ],
+        "ingredients": [
+            {
+                "recipe_id": r_id,
+                "name": ing.get("name"),
+                "quantity": ing.get("quantity"),
+                "unit": ing.get("unit"),
+            }
+            for ing in data.get("ingredients", [])
+        ],
+        "steps": [
+            {"recipe_id": r_id, "step_number": idx + 1, "instruction": step}
+            for idx, step in enumerate(data.get("steps", []))
+        ],
+    }
+
+
+def transform_interaction(data):
+    return {
+        "interactions": [
+            {
+                "interaction_id": data.get("interaction_id"),
+                "user_id": data.get("user_id"),
+                "recipe_id": data.get("recipe_id"),
+                "type": data.get("type"),
+                "rating": data.get("rating", ""),
+                "timestamp": str(data.get("timestamp")),
+            }
+        ]
+    }
+
+
+# Firestore collection -> (transform, output tables it produces)
+COLLECTIONS = {
+    "users": (transform_user, ["users"]),
+    "recipes": (transform_recipe, ["recipes", "ingredients", "steps"]),
+    "interactions": (transform_interaction, ["interactions"]),
+}
+
+
+# --- TARGETS ---
+# A target is one (project, database, bucket prefix) to extract. run_etl builds
+# a single target from the environment; run_etl_fanout takes a list of them.
+# Every path a target writes (backups, checkpoints) sits under its own prefix:
+# "<project>/<database>" unless given. The top level belongs to run_etl.
+
+
+def make_target(config, default_bucket=None):
+    """Builds a target from its config; raises ValueError on bad settings."""
+    project = config.get("project")
+    database = config.get("database", DATABASE_ID)
+    prefix = config.get("prefix")
+    if prefix is None:
+        prefix = "/".join(part for part in (project, database) if part)
+    bucket = config.get("bucket", default_bucket)
+    if not bucket:
+        raise ValueError(f"No bucket given for target {config}")
+
+    # Per-target quotas
+    try:
+        page_size = int(config.get("page_size", PAGE_SIZE))
+        reads_per_second = config.get("reads_per_second")
+        if reads_per_second is not None:
+            reads_per_second = float(reads_per_second)
+    except (TypeError, ValueError):
+        raise ValueError(f"page_size / reads_per_second must be numbers: {config}")
+    if page_size <= 0 or (reads_per_second is not None and reads_per_second <= 0):
+        raise ValueError(f"page_size / reads_per_second must be positive: {config}")
+
+    prefix = str(prefix).strip("/")
+    if prefix.split("/", 1)[0] in RESERVED_PREFIXES:
+        raise ValueError(
+            f"prefix {prefix!r} may not start with {', '.join(RESERVED_PREFIXES)}"
+        )
+    return {
+        "project": project,
+        "database": database,
+        "bucket": bucket,
+        "prefix": prefix,
+        "page_size": page_size,
+        "reads_per_second": reads_per_second,
+        "run_id": config.get("run_id"),
+        "name": f"{bucket}/{prefix}" if prefix else bucket,
+    }
+
+
+def target_path(target, *parts):
+    return "/".join(part for part in (target["prefix"], *parts) if part)
+
+
+# --- CHECKPOINTS ---
+# Each run keeps a JSON checkpoint at etl_runs/<run_id>/checkpoint.json holding
+# the extraction cursor and shard count per collection, the rows written per
+# table and the backup files already uploaded. Shard names are derived from
+# the shard count, so the checkpoint stays the same size however big the run
+# gets. A retry resumes from there; a finished run is a no-op.
+
+
+def new_checkpoint(run_id):
+    return {
+        "run_id": run_id,
+        "status": "running",
+        "collections": {
+            name: {"cursor": None, "pages": 0, "docs": 0, "shards": 0, "done": False}
+            for name in COLLECTIONS
+        },
+        "rows": {table: 0 for table in OUTPUT_FILES},
+        "uploaded": [],
+    }
+
+
+def checkpoint_blob(bucket, target, run_id):
+    return bucket.blob(
+        target_path(target, CHECKPOINT_PREFIX, run_id, "checkpoint.json")
+    )
+
+
+def load_checkpoint(bucket, target, run_id):
+    blob = checkpoint_blob(bucket, target, run_id)
+    if not blob.exists():
+        return new_checkpoint(run_id)
+    return json.loads(blob.download_as_text())
 
-    if not BUCKET_NAME:
-        return "Error: BUCKET_NAME env var missing.", 500
 
-    print(f"🚀 Starting ETL for Project: {PROJECT_ID} -> DB: 'recipe'")
+def save_checkpoint(bucket, target, checkpoint):
+    checkpoint_blob(bucket, target, checkpoint["run_id"]).upload_from_string(
+        json.dumps(checkpoint), content_type="application/json"
+    )
 
+
+def resolve_checkpoint(bucket, target, run_id=None):
+    """Explicit run_id wins; otherwise resume the unfinished run, if any."""
+    if run_id:
+        return load_checkpoint(bucket, target, run_id)
+
+    pointer = bucket.blob(target_path(target, CURRENT_RUN_BLOB))
+    if pointer.exists():
+        checkpoint = load_checkpoint(bucket, target, pointer.download_as_text().strip())
+        if checkpoint["status"] != "complete":
+            return checkpoint
+
+    return new_checkpoint(datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ"))
+
+
+# --- EXTRACT + TRANSFORM ---
+
+
+def serialize_rows(fields, rows):
+    mem_file = io.StringIO()
+    writer = csv.DictWriter(mem_file, fieldnames=fields)
+    writer.writerows(rows)  # No header; it is added when the shards are merged
+    return mem_file.getvalue()
+
+
+def shard_dir(target, checkpoint):
+    return target_path(target, CHECKPOINT_PREFIX, checkpoint["run_id"], "shards")
+
+
+def shard_name(target, checkpoint, table, collection, index):
+    return f"{shard_dir(target, checkpoint)}/{table}/{collection}-{index:05d}.csv"
+
+
+def extract_collection(db, bucket, target, checkpoint, name, deadline=None):
+    """Pages through a collection, writing one shard per table every
+    CHECKPOINT_EVERY_PAGES pages and saving the checkpoint after each shard.
+
+    Returns False if it stopped early because `deadline` (time.monotonic())
+    passed; calling it again later continues from the saved cursor.
+    """
+    state = checkpoint["collections"][name]
+    if state["done"]:
+        print(f"   -> {name}: already extracted ({state['docs']} docs)")
+        return True
+
+    transform, tables = COLLECTIONS[name]
+    collection = db.collection(name)
+    page_size = target["page_size"]
+    reads_per_second = target["reads_per_second"]
+    extract_span = perf.Span("extract", collection=name)
+    transform_span = perf.Span("transform", collection=name)
+    serialize_span = perf.Span("serialize", collection=name)
+    upload_span = perf.Span("upload", collection=name, kind="shard")
+    started = time.monotonic()
+    finished = False
+
+    # Rows buffered since the last shard, and the cursor they end at
+    buffer = {table: [] for table in tables}
+    buffered_pages = 0
+    buffered_docs = 0
+    cursor = state["cursor"]
+
+    def flush():
+        # Every table gets a shard (possibly empty), so names can be derived.
+        # A shard replayed after a crash simply overwrites its own object.
+        for table in tables:
+            rows = buffer[table]
+            with serialize_span.timing():
+                data = serialize_rows(OUTPUT_FILES[table][1], rows).encode("utf-8")
+            serialize_span.add(rows=len(rows), nbytes=len(data))
+            shard = shard_name(target, checkpoint, table, name, state["shards"])
+            with upload_span.timing():
+                bucket.blob(shard).upload_from_string(data, content_type="text/csv")
+            upload_span.add(rows=len(rows), nbytes=len(data))
+            checkpoint["rows"][table] += len(rows)
+            buffer[table] = []
+
+        state["cursor"] = cursor
+        state["pages"] += buffered_pages
+        state["docs"] += buffered_docs
+        state["shards"] += 1
+        save_checkpoint(bucket, target, checkpoint)
+
+    spans = (extract_span, transform_span, serialize_span, upload_span)
     try:
+        while True:
+            query = collection.order_by("__name__").limit(page_size)
+            if cursor:
+                query = query.start_after({"__name__": collection.document(cursor)})
+            with extract_span.timing():
+                docs = list(query.stream())
+            extract_span.add(docs=len(docs))
+
+            if docs:
+                produced = 0
+                with transform_span.timing():
+                    for doc in docs:
+                        for table, rows in transform(doc.to_dict()).items():
+                            buffer[table].extend(rows)
+                            produced += len(rows)
+                transform_span.add(docs=len(docs), rows=produced)
+                cursor = docs[-1].id
+                buffered_pages += 1
+                buffered_docs += len(docs)
+
+            finished = len(docs) < page_size
+            paused = not finished and deadline and time.monotonic() >= deadline
+            if buffered_pages and (
+                finished or paused or buffered_pages >= CHECKPOINT_EVERY_PAGES
+            ):
+                flush()
+                buffered_pages = 0
+                buffered_docs = 0
+            if finished or paused:
+                break
+
+            # Stay under the target's Firestore read quota, but not past the slice
+            if reads_per_second:
+                now = time.monotonic()
+                delay = extract_span.docs / reads_per_second - (now - started)
+                if deadline:
+                    delay = min(delay, deadline - now)
+                time.sleep(max(0.0, delay))
+    except Exception as e:
+        for s in spans:
+            s.emit(status="error", error=str(e))
+        raise
+
+    for s in spans:
+        s.emit()
+    if not finished:
+        print(f"   -> {name}: paused after {state['docs']} docs")
+        return False
+
+    state["done"] = True
+    save_checkpoint(bucket, target, checkpoint)
+    print(f"   -> {name}: {state['docs']} docs in {state['pages']} pages")
+    return True
+
+
+# --- LOAD ---
+
+
+def compose(bucket, sources, destination, scratch_prefix):
+    """Concatenates objects server-side, in rounds of COMPOSE_LIMIT sources.
+
+    Intermediate objects go under `scratch_prefix`, so the destination is
+    written exactly once.
+    """
+    level = 0
+    while len(sources) > COMPOSE_LIMIT:
+        merged = []
+        for i in range(0, len(sources), COMPOSE_LIMIT):
+            blob = bucket.blob(f"{scratch_prefix}-{level}-{i // COMPOSE_LIMIT:05d}")
+            blob.compose([bucket.blob(name) for name in sources[i : i + COMPOSE_LIMIT]])
+            merged.append(blob.name)
+        sources = merged
+        level += 1
+
+    blob = bucket.blob(destination)
+    blob.content_type = "text/csv"
+    blob.compose([bucket.blob(name) for name in sources])
+    return blob
+
+
+def upload_table(bucket, target, checkpoint, table):
+    filename, fields = OUTPUT_FILES[table]
+    if filename in checkpoint["uploaded"]:
+        print(f"   -> {filename}: already uploaded")
+        return
+
+    with perf.span("upload", file=filename, kind="backup") as s:
+        header = f"{shard_dir(target, checkpoint)}/{table}/_header.csv"
+        header_row = serialize_rows(fields, [dict(zip(fields, fields))])
+        bucket.blob(header).upload_from_string(header_row, content_type="text/csv")
+        sources = [header] + [
+            shard_name(target, checkpoint, table, name, index)
+            for name, (_, tables) in COLLECTIONS.items()
+            if table in tables
+            for index in range(checkpoint["collections"][name]["shards"])
+        ]
+        blob = compose(
+            bucket,
+            sources,
+            target_path(target, BACKUP_PREFIX, filename),
+            scratch_prefix=f"{shard_dir(target, checkpoint)}/{table}/_compose",
+        )
+        s.add(rows=checkpoint["rows"][table], nbytes=blob.size or 0)
+
+    checkpoint["uploaded"].append(filename)
+    save_checkpoint(bucket, target, checkpoint)
+    print(f"   -> Uploaded {filename}")
+
+
+def finish_run(bucket, target, checkpoint):
+    checkpoint["status"] = "complete"
+    save_checkpoint(bucket, target, checkpoint)
+
+    pointer = bucket.blob(target_path(target, CURRENT_RUN_BLOB))
+    if pointer.exists():
+        pointer.delete()
+
+    # The checkpoint itself is kept so re-running this run_id stays a no-op.
+    for blob in bucket.list_blobs(prefix=f"{shard_dir(target, checkpoint)}/"):
+        blob.delete()
+
+
+def run_target(db, bucket, target, checkpoint, deadline=None):
+    """Runs (or resumes) an unfinished checkpointed ETL run for a target.
+
+    `checkpoint` comes from resolve_checkpoint(); callers skip completed runs
+    before connecting to Firestore. Returns the checkpoint; its status stays
+    "running" if `deadline` passed before the run finished.
+    """
+    run_id = checkpoint["run_id"]
+    print(f"🧾 Run ID: {run_id}")
+    bucket.blob(target_path(target, CURRENT_RUN_BLOB)).upload_from_string(run_id)
+    save_checkpoint(bucket, target, checkpoint)
+
+    # --- 2. EXTRACT + 3. TRANSFORM ---
+    print("📥 Extracting and transforming data...")
+    for name in COLLECTIONS:
+        if not extract_collection(db, bucket, target, checkpoint, name, deadline):
+            return checkpoint
+
+    # --- 4. LOAD ---
+    recipe_count = checkpoint["collections"]["recipes"]["docs"]
+    print(f"💾 Uploading {recipe_count} recipes to {target['bucket']}...")
+    uploaded = len(checkpoint["uploaded"])
+    for table in OUTPUT_FILES:
+        # Upload at least one file per slice, so every slice makes progress
+        progressed = len(checkpoint["uploaded"]) > uploaded
+        if progressed and deadline and time.monotonic() >= deadline:
+            return checkpoint
+        upload_table(bucket, target, checkpoint, table)
+
+    finish_run(bucket, target, checkpoint)
+    return checkpoint
+
+
+def run_pipeline(request, bucket_name, project_id):
+    """Runs (or resumes) one checkpointed ETL run for the default database."""
+    run_id = None
+    try:
+        target = make_target(
+            {"project": project_id, "prefix": ""}, default_bucket=bucket_name
+        )
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(bucket_name)
+
+        checkpoint = resolve_checkpoint(
+            bucket, target, request.args.get("run_id") if request else None
+        )
+        run_id = checkpoint["run_id"]
+        perf.bind(run_id=run_id)
+        recipe_count = checkpoint["collections"]["recipes"]["docs"]
+
+        if checkpoint["status"] == "complete":
+            print(f"⏭️ Run {run_id} already complete. Nothing to do.")
+            return (
+                f"Run {run_id} already complete ({recipe_count} recipes).",
+                200,
+            )
+
         # --- CONNECT TO SPECIFIC DATABASE ---
         # This is the critical fix. We explicitly tell the client which DB to use.
-        db = firestore.Client(project=PROJECT_ID, database="recipe")
-        storage_client = storage.Client()
+        db = firestore.Client(project=project_id, database=target["database"])
 
         # Verify connection by trying to read one document
         print("🔍 Verifying database connection...")
@@ -32,120 +485,166 @@ def run_etl(request):
         else:
             print(f"✅ Connected! Found user: {test_docs[0].id}")
 
-        # --- 2. EXTRACT ---
-        print("📥 Extracting data...")
-        users_docs = db.collection("users").stream()
-        recipes_docs = db.collection("recipes").stream()
-        interactions_docs = db.collection("interactions").stream()
-
-        # --- 3. TRANSFORM ---
-        print("⚙️ Transforming data...")
-        user_rows = []
-        recipe_rows = []
-        ingredient_rows = []
-        step_rows = []
-        interaction_rows = []
-
-        # Process Users
-        for doc in users_docs:
-            data = doc.to_dict()
-            user_rows.append(
-                {
-                    "user_id": data.get("user_id"),
-                    "username": data.get("username"),
-                    "email": data.get("email"),
-                    "created_at": str(data.get("created_at")),
-                }
-            )
+        checkpoint = run_target(db, bucket, target, checkpoint)
+        recipe_count = checkpoint["collections"]["recipes"]["docs"]
 
-        # Process Recipes
-        for doc in recipes_docs:
-            data = doc.to_dict()
-            r_id = data.get("recipe_id")
-            recipe_rows.append(
-                {
-                    "recipe_id": r_id,
-                    "title": data.get("title"),
-                    "author_id": data.get("author_id"),
-                    "prep_time_minutes": data.get("prep_time_minutes"),
-                    "difficulty": data.get("difficulty"),
-                    "created_at": str(data.get("created_at")),
-                }
-            )
-            for ing in data.get("ingredients", []):
-                ingredient_rows.append(
-                    {
-                        "recipe_id": r_id,
-                        "name": ing.get("name"),
-                        "quantity": ing.get("quantity"),
-                        "unit": ing.get("unit"),
-                    }
-                )
-            for idx, step in enumerate(data.get("steps", [])):
-                step_rows.append(
-                    {"recipe_id": r_id, "step_number": idx + 1, "instruction": step}
+        return (
+            f"Success! Run {run_id} processed {recipe_count} recipes. Files in {bucket_name}/{BACKUP_PREFIX}/",
+            200,
+        )
+
+    except Exception as e:
+        print(f"❌ CRITICAL ERROR: {e}")
+        if run_id:
+            print(f"🔁 Retry to resume run {run_id} from its last checkpoint.")
+        return f"Pipeline Failed: {str(e)}", 500
+
+
+# --- FAN-OUT SCHEDULER ---
+# Targets run on a bounded worker pool in time slices: a worker runs one
+# target until its slice ends, the checkpoint is saved and the target goes to
+# the back of the queue. A huge tenant therefore only ever holds one worker
+# for one slice at a time, and small tenants finish without waiting for it.
+
+
+def run_slice(target, storage_client, dbs, run_ids, deadline):
+    perf.bind(
+        target=target["name"],
+        project=target["project"],
+        database=target["database"],
+    )
+    bucket = storage_client.bucket(target["bucket"])
+    checkpoint = resolve_checkpoint(
+        bucket, target, run_ids.get(target["name"], target["run_id"])
+    )
+    run_ids[target["name"]] = checkpoint["run_id"]
+    perf.bind(run_id=checkpoint["run_id"])
+    if checkpoint["status"] == "complete":
+        print(f"⏭️ [{target['name']}] Run {checkpoint['run_id']} already complete.")
+        return checkpoint
+
+    key = (target["project"], target["database"])
+    db = dbs.get(key)
+    if db is None:
+        db = dbs[key] = firestore.Client(
+            project=target["project"], database=target["database"]
+        )
+    with perf.sampled_thread():
+        return run_target(db, bucket, target, checkpoint, deadline)
+
+
+def run_fanout(targets, max_workers, slice_seconds, storage_client=None):
+    """Runs every target to completion; returns a result per target name."""
+    storage_client = storage_client or storage.Client()
+    dbs = {}
+    run_ids = {}
+    results = {}
+    pending = deque(targets)
+    # With a free worker per target nothing can starve, so skip the slicing.
+    sliced = len(targets) > max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while pending or running:
+            while pending and len(running) < max_workers:
+                target = pending.popleft()
+                deadline = time.monotonic() + slice_seconds if sliced else None
+                ctx = contextvars.copy_context()  # Keep perf fields per thread
+                future = pool.submit(
+                    ctx.run, run_slice, target, storage_client, dbs, run_ids, deadline
                 )
+                running[future] = target
 
-        # Process Interactions
-        for doc in interactions_docs:
-            data = doc.to_dict()
-            interaction_rows.append(
-                {
-                    "interaction_id": data.get("interaction_id"),
-                    "user_id": data.get("user_id"),
-                    "recipe_id": data.get("recipe_id"),
-                    "type": data.get("type"),
-                    "rating": data.get("rating", ""),
-                    "timestamp": str(data.get("timestamp")),
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                target = running.pop(future)
+                try:
+                    checkpoint = future.result()
+                except Exception as e:
+                    print(f"❌ [{target['name']}] Failed: {e}")
+                    results[target["name"]] = {
+                        "status": "failed",
+                        "run_id": run_ids.get(target["name"]),
+                        "error": str(e),
+                    }
+                    continue
+                if checkpoint["status"] != "complete":
+                    pending.append(target)  # Back of the queue; others go first
+                    continue
+                print(f"✅ [{target['name']}] Run {checkpoint['run_id']} complete.")
+                results[target["name"]] = {
+                    "status": "complete",
+                    "run_id": checkpoint["run_id"],
+                    "recipes": checkpoint["collections"]["recipes"]["docs"],
                 }
-            )
+    return results
 
-        # --- 4. LOAD ---
-        print(f"💾 Uploading {len(recipe_rows)} recipes to {BUCKET_NAME}...")
-        bucket = storage_client.bucket(BUCKET_NAME)
 
-        def upload_file(filename, fields, rows):
-            mem_file = io.StringIO()
-            writer = csv.DictWriter(mem_file, fieldnames=fields)
-            writer.writeheader()
-            writer.writerows(rows)
+# Triggered by HTTP request
+@functions_framework.http
+def run_etl(request):
+    # 1. Configuration
+    BUCKET_NAME = os.environ.get("BUCKET_NAME")
+    PROJECT_ID = os.environ.get("GCP_PROJECT")  # Cloud Functions set this automatically
 
-            blob = bucket.blob(f"backups/{filename}")
-            blob.upload_from_string(mem_file.getvalue(), content_type="text/csv")
-            print(f"   -> Uploaded {filename}")
+    if not BUCKET_NAME:
+        return "Error: BUCKET_NAME env var missing.", 500
 
-        upload_file(
-            "users.csv", ["user_id", "username", "email", "created_at"], user_rows
-        )
-        upload_file(
-            "recipe.csv",
-            [
-                "recipe_id",
-                "title",
-                "author_id",
-                "prep_time_minutes",
-                "difficulty",
-                "created_at",
-            ],
-            recipe_rows,
-        )
-        upload_file(
-            "ingredients.csv",
-            ["recipe_id", "name", "quantity", "unit"],
-            ingredient_rows,
-        )
-        upload_file("steps.csv", ["recipe_id", "step_number", "instruction"], step_rows)
-        upload_file(
-            "interactions.csv",
-            ["interaction_id", "user_id", "recipe_id", "type", "rating", "timestamp"],
-            interaction_rows,
-        )
+    print(f"🚀 Starting ETL for Project: {PROJECT_ID} -> DB: '{DATABASE_ID}'")
+    perf.new_context(entry_point="run_etl", project=PROJECT_ID, database=DATABASE_ID)
 
-        return (
-            f"Success! Processed {len(recipe_rows)} recipes. Files in {BUCKET_NAME}/backups/",
-            200,
-        )
+    with perf.profile("run_etl"):
+        return run_pipeline(request, BUCKET_NAME, PROJECT_ID)
 
-    except Exception as e:
-        print(f"❌ CRITICAL ERROR: {e}")
-        return f"Pipeline Failed: {str(e)}", 500
+
+# Triggered by HTTP request with a JSON body:
+#   {"targets": [{"project": "...", "database": "...", "prefix": "eu/acme",
+#                 "bucket": "...", "page_size": 500, "reads_per_second": 2000}],
+#    "max_workers": 8, "slice_seconds": 60}
+# Only "project" is required per target; "bucket" defaults to BUCKET_NAME and
+# "prefix" to "<project>/<database>". Targets need distinct bucket/prefix pairs.
+@functions_framework.http
+def run_etl_fanout(request):
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return "Error: the body must be a JSON object.", 400
+    configs = body.get("targets", [])
+    if not isinstance(configs, list) or not all(
+        isinstance(config, dict) for config in configs
+    ):
+        return "Error: targets must be a list of objects.", 400
+    if not all(config.get("project") for config in configs):
+        return "Error: every target needs a project.", 400
+    try:
+        targets = [
+            make_target(config, default_bucket=os.environ.get("BUCKET_NAME"))
+            for config in configs
+        ]
+    except ValueError as e:
+        return f"Error: {e}", 400
+    if not targets:
+        return "Error: no targets given.", 400
+    if any(not target["prefix"] for target in targets):
+        return "Error: the top-level prefix is reserved for run_etl.", 400
+    names = [target["name"] for target in targets]
+    if len(set(names)) != len(names):
+        return "Error: targets must have distinct bucket/prefix.", 400
+
+    try:
+        max_workers = int(body.get("max_workers", FANOUT_MAX_WORKERS))
+        slice_seconds = float(body.get("slice_seconds", FANOUT_SLICE_SECONDS))
+    except (TypeError, ValueError):
+        return "Error: max_workers / slice_seconds must be numbers.", 400
+    if max_workers <= 0:
+        return "Error: max_workers must be positive.", 400
+    if slice_seconds < MIN_SLICE_SECONDS:
+        return f"Error: slice_seconds must be at least {MIN_SLICE_SECONDS}.", 400
+
+    print(f"🚀 Starting fan-out ETL for {len(targets)} targets ({max_workers} workers)")
+    perf.new_context(entry_point="run_etl_fanout")
+
+    with perf.profile("run_etl_fanout"), perf.span("fanout", targets=len(targets)):
+        results = run_fanout(targets, max_workers, slice_seconds)
+
+    failed = [name for name, result in results.items() if result["status"] == "failed"]
+    return json.dumps(results), 500 if failed else 200
@@ -0,0 +1,241 @@
+"""Lightweight per-stage instrumentation.
+
+Every span is printed as one JSON line, which Cloud Logging stores as a
+structured record (jsonPayload). Each record carries the stage name, its
+duration, rows / docs / bytes processed, docs per second and the process
+peak RSS so far (process_peak_rss_mb, which only ever grows on a warm
+instance).
+
+Set ETL_TRACE_MEMORY=1 to also record the peak Python memory allocated while
+each span was running (peak_memory_mb, via tracemalloc). It slows the run
+down, and with several threads a span's peak includes the other threads'
+allocations.
+
+Set ETL_PROFILE=1 to also run a sampling profiler around an entry point
+(ETL_PROFILE_INTERVAL_MS sets the sampling interval, default 10 ms). It
+samples the thread that called profile() plus worker threads wrapped in
+sampled_thread(), and skips threads idling in a wait.
+
+This file is copied verbatim into every deployable folder
+(cloud_function/, bigquery_loader_function/, src/) because Cloud Functions
+upload one folder at a time.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+PROFILE_ENABLED = os.environ.get("ETL_PROFILE", "").lower() in ("1", "true", "yes")
+DEFAULT_PROFILE_INTERVAL_MS = 10.0
+PROFILE_TOP_N = 15
+TRACE_MEMORY = os.environ.get("ETL_TRACE_MEMORY", "").lower() in ("1", "true", "yes")
+
+if TRACE_MEMORY and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+# Spans currently inside timing(); each gets the traced peak while it is open
+_open_spans = []
+_memory_lock = threading.Lock()
+
+# Threads the profiler samples (see profile() and sampled_thread())
+_sampled_threads = set()
+
+# Fields (entry point, run ID, ...) attached to every record of the current run
+_context = contextvars.ContextVar("perf_context", default={})
+
+
+def new_context(**fields):
+    """Starts a fresh set of fields (call once per entry point invocation)."""
+    _context.set(dict(fields))
+
+
+def bind(**fields):
+    """Adds fields attached to every record emitted from this context."""
+    _context.set({**_context.get(), **fields})
+
+
+def process_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def log(message, **fields):
+    record = {"severity": "INFO", "message": message, **_context.get(), **fields}
+    print(json.dumps(record, default=str), flush=True)
+
+
+def _record_traced_peak():
+    """Credits the traced peak so far to every open span (lock held)."""
+    _, peak = tracemalloc.get_traced_memory()
+    for s in _open_spans:
+        s.peak_bytes = max(s.peak_bytes, peak)
+
+
+class Span:
+    """Accumulates time and counters for one stage until emit() is called.
+
+    Use timing() around each slice of work, so one span can cover a stage
+    that is interleaved with others (e.g. extract/transform per page).
+    """
+
+    def __init__(self, stage, **fields):
+        self.stage = stage
+        self.fields = fields
+        self.duration = 0.0
+        self.rows = 0
+        self.docs = 0
+        self.bytes = 0
+        self.peak_bytes = 0
+
+    @contextmanager
+    def timing(self):
+        if TRACE_MEMORY:
+            with _memory_lock:
+                _record_traced_peak()
+                tracemalloc.reset_peak()
+                _open_spans.append(self)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.duration += time.perf_counter() - start
+            if TRACE_MEMORY:
+                with _memory_lock:
+                    _record_traced_peak()
+                    _open_spans.remove(self)
+
+    def add(self, rows=0, docs=0, nbytes=0):
+        self.rows += rows
+        self.docs += docs
+        self.bytes += nbytes
+
+    def emit(self, status="ok", **fields):
+        units = self.docs or self.rows
+        log(
+            f"span {self.stage}",
+            severity="ERROR" if status == "error" else "INFO",
+            stage=self.stage,
+            status=status,
+            duration_s=round(self.duration, 4),
+            rows=self.rows,
+            docs=self.docs,
+            bytes=self.bytes,
+            docs_per_s=round(units / self.duration, 1) if self.duration else None,
+            peak_memory_mb=(
+                round(self.peak_bytes / (1024 * 1024), 1) if TRACE_MEMORY else None
+            ),
+            process_peak_rss_mb=process_peak_rss_mb(),
+            **self.fields,
+            **fields,
+        )
+
+
+@contextmanager
+def span(stage, **fields):
+    """Times a block and emits it as a single span, marking errors."""
+    s = Span(stage, **fields)
+    try:
+        with s.timing():
+            yield s
+    except Exception as e:
+        s.emit(status="error", error=str(e))
+        raise
+    s.emit()
+
+
+class _Sampler(threading.Thread):
+    """Samples the stacks of the registered threads and counts the innermost
+    frames. Frames inside threading.py (lock / condition waits) are idle time
+    and are not counted."""
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in _sampled_threads:
+                    continue
+                code = frame.f_code
+                if code.co_filename == threading.__file__:
+                    continue
+                location = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                self.samples[f"{location}:{frame.f_lineno}"] += 1
+
+
+def _profile_interval_ms():
+    value = os.environ.get("ETL_PROFILE_INTERVAL_MS", "")
+    try:
+        interval_ms = float(value or DEFAULT_PROFILE_INTERVAL_MS)
+    except ValueError:
+        interval_ms = 0
+    if interval_ms <= 0:
+        log(
+            f"ignoring ETL_PROFILE_INTERVAL_MS={value!r}",
+            severity="WARNING",
+            stage="profile",
+        )
+        return DEFAULT_PROFILE_INTERVAL_MS
+    return interval_ms
+
+
+@contextmanager
+def sampled_thread():
+    """Includes the current worker thread in the running profile, if any."""
+    if not PROFILE_ENABLED:
+        yield
+        return
+
+    thread_id = threading.get_ident()
+    _sampled_threads.add(thread_id)
+    try:
+        yield
+    finally:
+        _sampled_threads.discard(thread_id)
+
+
+@contextmanager
+def profile(name):
+    """Runs the sampling profiler around a block when ETL_PROFILE is set."""
+    if not PROFILE_ENABLED:
+        yield
+        return
+
+    interval_ms = _profile_interval_ms()
+    sampler = _Sampler(interval_ms / 1000)
+    sampler.start()
+    try:
+        with sampled_thread():
+            yield
+    finally:
+        sampler.stopped.set()
+        sampler.join()
+        total = sum(sampler.samples.values())
+        log(
+            f"profile {name}",
+            stage="profile",
+            entry=name,
+            samples=total,
+            interval_ms=interval_ms,
+            hot_frames=[
+                {"frame": frame, "samples": n, "share": round(n / total, 3)}
+                for frame, n in sampler.samples.most_common(PROFILE_TOP_N)
+            ],
+        )
@@ -1,5 +1,6 @@
 import csv
 import os
+import perf
 import re
 from datetime import datetime
 
@@ -32,8 +33,11 @@ def load_csv(filename):
     if not os.path.exists(filename):
         print(f"Error: File {filename} not found. Run ETL pipeline first.")
         return []
-    with open(filename, mode="r", encoding="utf-8") as f:
-        return list(csv.DictReader(f))
+    with perf.span("read", file=filename) as s:
+        with open(filename, mode="r", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        s.add(rows=len(rows), nbytes=os.path.getsize(filename))
+    return rows
 
 
 def get_ids_from_list(data_list, id_column):
@@ -48,6 +52,7 @@ def check_email(email):
 
 def validate_data():
     print("STARTING DATA QUALITY VALIDATION...\n")
+    perf.new_context(entry_point="validate_data")
 
     # 1. LOAD ALL DATA
     data = {name: load_csv(filename) for name, filename in INPUT_FILES.items()}
@@ -69,34 +74,38 @@ def validate_data():
     def run_check(table_name, rows, validator_func):
         print(f" Validating: {table_name}...")
         invalid_count = 0
-
-        for row in rows:
-            issues = validator_func(row)
-            status = "FAIL" if issues else "PASS"
-
-            # Determine a primary ID for the report
-            row_id = (
-                row.get("recipe_id")
-                or row.get("user_id")
-                or row.get("interaction_id")
-                or "N/A"
-            )
-
-            # Add to CSV Report Data
-            full_report_data.append(
-                {
-                    "Table": table_name,
-                    "Record_ID": row_id,
-                    "Status": status,
-                    "Issues": "; ".join(issues) if issues else "OK",
-                    "Validated_At": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                }
-            )
-
-            if issues:
-                invalid_count += 1
-                print(f" FAIL [{row_id}]: {', '.join(issues)}")
-
+        table_span = perf.Span("validate", table=table_name)
+        table_span.add(rows=len(rows))
+
+        with table_span.timing():
+            for row in rows:
+                issues = validator_func(row)
+                status = "FAIL" if issues else "PASS"
+
+                # Determine a primary ID for the report
+                row_id = (
+                    row.get("recipe_id")
+                    or row.get("user_id")
+                    or row.get("interaction_id")
+                    or "N/A"
+                )
+
+                # Add to CSV Report Data
+                full_report_data.append(
+                    {
+                        "Table": table_name,
+                        "Record_ID": row_id,
+                        "Status": status,
+                        "Issues": "; ".join(issues) if issues else "OK",
+                        "Validated_At": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    }
+                )
+
+                if issues:
+                    invalid_count += 1
+                    print(f" FAIL [{row_id}]: {', '.join(issues)}")
+
+        table_span.emit(invalid=invalid_count)
         return invalid_count
 
     # --- 3. DEFINE VALIDATORS ---
@@ -197,4 +206,5 @@ def validate_data():
 
 
 if __name__ == "__main__":
-    validate_data()
+    with perf.profile("validate_data"):
+        validate_data()
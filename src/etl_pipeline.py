@@ -1,13 +1,24 @@
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
+from datetime import datetime, timezone
 import csv
+import json
 import os
+import perf
+import shutil
+import sys
 
 # --- 1. CONFIGURATION ---
 
 bucket_name = "saurav_recipe_backup"
 key_file = "serviceaccount.json"
 
+CHECKPOINT_DIR = "checkpoints"
+CURRENT_RUN_FILE = os.path.join(CHECKPOINT_DIR, "current_run")
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "500"))
+# Pages buffered per shard; the checkpoint is saved once per shard
+CHECKPOINT_EVERY_PAGES = int(os.environ.get("CHECKPOINT_EVERY_PAGES", "20"))
+
 if not firebase_admin._apps:
     cred = credentials.Certificate(key_file)
     firebase_admin.initialize_app(cred, {"storageBucket": bucket_name})
@@ -17,47 +28,49 @@ db = firestore.client(database_id="recipe")
 
 bucket = storage.bucket()
 
+# Output table -> (CSV file name, columns)
+OUTPUT_FILES = {
+    "users": ("users.csv", ["user_id", "username", "email", "created_at"]),
+    "recipes": (
+        "recipe.csv",
+        [
+            "recipe_id",
+            "title",
+            "author_id",
+            "prep_time_minutes",
+            "difficulty",
+            "created_at",
+        ],
+    ),
+    "ingredients": ("ingredients.csv", ["recipe_id", "name", "quantity", "unit"]),
+    "steps": ("steps.csv", ["recipe_id", "step_number", "instruction"]),
+    "interactions": (
+        "interactions.csv",
+        ["interaction_id", "user_id", "recipe_id", "type", "rating", "timestamp"],
+    ),
+}
 
-def run_etl_pipeline():
-    print("Starting ETL Pipeline...")
-
-    # --- 2. EXTRACT ---
-    print(" Extracting data from Firestore...")
-
-    # STREAMING FROM YOUR SPECIFIC COLLECTIONS
-    users_docs = db.collection("users").stream()
-    recipes_docs = db.collection("recipes").stream()
-    interactions_docs = db.collection(
-        "interactions"
-    ).stream()  # Matches your seed script
 
-    # --- 3. TRANSFORM ---
-    print(" Transforming data...")
+# --- TRANSFORMS (one Firestore document -> rows per output table) ---
 
-    user_rows = []
-    recipe_rows = []
-    ingredient_rows = []
-    step_rows = []
-    interaction_rows = []
 
-    # Process Users
-    for doc in users_docs:
-        data = doc.to_dict()
-        user_rows.append(
+def transform_user(data):
+    return {
+        "users": [
             {
                 "user_id": data.get("user_id"),
                 "username": data.get("username"),
                 "email": data.get("email"),
                 "created_at": data.get("created_at"),
             }
-        )
+        ]
+    }
 
-    # Process Recipes
-    for doc in recipes_docs:
-        data = doc.to_dict()
-        r_id = data.get("recipe_id")
 
-        recipe_rows.append(
+def transform_recipe(data):
+    r_id = data.get("recipe_id")
+    return {
+        "recipes": [
             {
                 "recipe_id": r_id,
                 "title": data.get("title"),
@@ -66,27 +79,26 @@ def run_etl_pipeline():
                 "difficulty": data.get("difficulty"),
                 "created_at": data.get("created_at"),
             }
-        )
-
-        for ing in data.get("ingredients", []):
-            ingredient_rows.append(
-                {
-                    "recipe_id": r_id,
-                    "name": ing.get("name"),
-                    "quantity": ing.get("quantity"),
-                    "unit": ing.get("unit"),
-                }
-            )
-
-        for index, step_text in enumerate(data.get("steps", [])):
-            step_rows.append(
-                {"recipe_id": r_id, "step_number": index + 1, "instruction": step_text}
-            )
-
-    # Process Interactions
-    for doc in interactions_docs:
-        data = doc.to_dict()
-        interaction_rows.append(
+        ],
+        "ingredients": [
+            {
+                "recipe_id": r_id,
+                "name": ing.get("name"),
+                "quantity": ing.get("quantity"),
+                "unit": ing.get("unit"),
+            }
+            for ing in data.get("ingredients", [])
+        ],
+        "steps": [
+            {"recipe_id": r_id, "step_number": index + 1, "instruction": step_text}
+            for index, step_text in enumerate(data.get("steps", []))
+        ],
+    }
+
+
+def transform_interaction(data):
+    return {
+        "interactions": [
             {
                 "interaction_id": data.get("interaction_id"),
                 "user_id": data.get("user_id"),
@@ -95,56 +107,247 @@ def run_etl_pipeline():
                 "rating": data.get("rating", ""),
                 "timestamp": data.get("timestamp"),
             }
-        )
+        ]
+    }
+
+
+# STREAMING FROM YOUR SPECIFIC COLLECTIONS
+# Firestore collection -> (transform, output tables it produces)
+COLLECTIONS = {
+    "users": (transform_user, ["users"]),
+    "recipes": (transform_recipe, ["recipes", "ingredients", "steps"]),
+    "interactions": (
+        transform_interaction,
+        ["interactions"],
+    ),  # Matches your seed script
+}
+
+
+# --- CHECKPOINTS ---
+# Each run keeps checkpoints/<run_id>/checkpoint.json with the extraction
+# cursor and shard count per collection, the rows written per table, the CSVs
+# generated and the objects already uploaded. Shard paths are derived from the
+# shard count. Re-running the same run ID resumes from there.
+
+
+def new_checkpoint(run_id):
+    return {
+        "run_id": run_id,
+        "status": "running",
+        "collections": {
+            name: {"cursor": None, "pages": 0, "docs": 0, "shards": 0, "done": False}
+            for name in COLLECTIONS
+        },
+        "rows": {table: 0 for table in OUTPUT_FILES},
+        "generated": [],
+        "uploaded": [],
+    }
+
+
+def checkpoint_path(run_id):
+    return os.path.join(CHECKPOINT_DIR, run_id, "checkpoint.json")
+
+
+def load_checkpoint(run_id):
+    path = checkpoint_path(run_id)
+    if not os.path.exists(path):
+        return new_checkpoint(run_id)
+    with open(path, mode="r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint):
+    path = checkpoint_path(checkpoint["run_id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)  # Atomic, so a crash never leaves half a checkpoint
+
+
+def resolve_checkpoint(run_id=None):
+    """Explicit run ID wins; otherwise resume the unfinished run, if any."""
+    if run_id:
+        return load_checkpoint(run_id)
+
+    if os.path.exists(CURRENT_RUN_FILE):
+        with open(CURRENT_RUN_FILE, mode="r", encoding="utf-8") as f:
+            checkpoint = load_checkpoint(f.read().strip())
+        if checkpoint["status"] != "complete":
+            return checkpoint
+
+    return new_checkpoint(datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ"))
+
+
+# --- EXTRACT + TRANSFORM ---
+
+
+def shard_path(checkpoint, table, collection, index):
+    return os.path.join(
+        CHECKPOINT_DIR,
+        checkpoint["run_id"],
+        "shards",
+        table,
+        f"{collection}-{index:05d}.csv",
+    )
+
+
+def extract_collection(checkpoint, name):
+    """Pages through a collection, writing one shard per table every
+    CHECKPOINT_EVERY_PAGES pages and saving the checkpoint after each shard."""
+    state = checkpoint["collections"][name]
+    if state["done"]:
+        print(f" Skipping {name}: already extracted ({state['docs']} docs)")
+        return
+
+    transform, tables = COLLECTIONS[name]
+    collection = db.collection(name)
+    extract_span = perf.Span("extract", collection=name)
+    transform_span = perf.Span("transform", collection=name)
+    serialize_span = perf.Span("serialize", collection=name)
+
+    # Rows buffered since the last shard, and the cursor they end at
+    buffer = {table: [] for table in tables}
+    buffered_pages = 0
+    buffered_docs = 0
+    cursor = state["cursor"]
+
+    def flush():
+        # Every table gets a shard (possibly empty), so paths can be derived.
+        # A shard replayed after a crash simply overwrites its own file.
+        for table in tables:
+            rows = buffer[table]
+            shard = shard_path(checkpoint, table, name, state["shards"])
+            os.makedirs(os.path.dirname(shard), exist_ok=True)
+            with serialize_span.timing():
+                with open(shard, mode="w", newline="", encoding="utf-8") as file:
+                    writer = csv.DictWriter(file, fieldnames=OUTPUT_FILES[table][1])
+                    writer.writerows(rows)
+            serialize_span.add(rows=len(rows), nbytes=os.path.getsize(shard))
+            checkpoint["rows"][table] += len(rows)
+            buffer[table] = []
+
+        state["cursor"] = cursor
+        state["pages"] += buffered_pages
+        state["docs"] += buffered_docs
+        state["shards"] += 1
+        save_checkpoint(checkpoint)
+
+    spans = (extract_span, transform_span, serialize_span)
+    try:
+        while True:
+            query = collection.order_by("__name__").limit(PAGE_SIZE)
+            if cursor:
+                query = query.start_after({"__name__": collection.document(cursor)})
+            with extract_span.timing():
+                docs = list(query.stream())
+            extract_span.add(docs=len(docs))
+
+            if docs:
+                produced = 0
+                with transform_span.timing():
+                    for doc in docs:
+                        for table, rows in transform(doc.to_dict()).items():
+                            buffer[table].extend(rows)
+                            produced += len(rows)
+                transform_span.add(docs=len(docs), rows=produced)
+                cursor = docs[-1].id
+                buffered_pages += 1
+                buffered_docs += len(docs)
+
+            finished = len(docs) < PAGE_SIZE
+            if buffered_pages and (
+                finished or buffered_pages >= CHECKPOINT_EVERY_PAGES
+            ):
+                flush()
+                buffered_pages = 0
+                buffered_docs = 0
+            if finished:
+                break
+    except Exception as e:
+        for s in spans:
+            s.emit(status="error", error=str(e))
+        raise
+
+    state["done"] = True
+    save_checkpoint(checkpoint)
+    for s in spans:
+        s.emit()
+    print(f" Extracted {name}: {state['docs']} docs in {state['pages']} pages")
+
+
+def run_etl_pipeline(run_id=None):
+    checkpoint = resolve_checkpoint(run_id)
+    run_id = checkpoint["run_id"]
+    perf.new_context(entry_point="run_etl_pipeline", run_id=run_id)
+
+    if checkpoint["status"] == "complete":
+        print(f"Run {run_id} already complete. Nothing to do.")
+        return
+
+    print(f"Starting ETL Pipeline (run {run_id})...")
+    save_checkpoint(checkpoint)
+    with open(CURRENT_RUN_FILE, mode="w", encoding="utf-8") as f:
+        f.write(run_id)
+
+    # --- 2. EXTRACT + 3. TRANSFORM ---
+    print(" Extracting and transforming data from Firestore...")
+    for name in COLLECTIONS:
+        extract_collection(checkpoint, name)
 
     # --- 4. LOAD (Save CSVs) ---
-    print(f"Saving CSV files (Found {len(interaction_rows)} interactions)...")
-
-    files_to_generate = [
-        ("users.csv", ["user_id", "username", "email", "created_at"], user_rows),
-        (
-            "recipe.csv",
-            [
-                "recipe_id",
-                "title",
-                "author_id",
-                "prep_time_minutes",
-                "difficulty",
-                "created_at",
-            ],
-            recipe_rows,
-        ),
-        ("ingredients.csv", ["recipe_id", "name", "quantity", "unit"], ingredient_rows),
-        ("steps.csv", ["recipe_id", "step_number", "instruction"], step_rows),
-        (
-            "interactions.csv",
-            ["interaction_id", "user_id", "recipe_id", "type", "rating", "timestamp"],
-            interaction_rows,
-        ),
-    ]
-
-    files_uploaded = []
-
-    for filename, fields, rows in files_to_generate:
-        with open(filename, mode="w", newline="", encoding="utf-8") as file:
-            writer = csv.DictWriter(file, fieldnames=fields)
-            writer.writeheader()
-            writer.writerows(rows)
-        files_uploaded.append(filename)
+    interaction_count = checkpoint["collections"]["interactions"]["docs"]
+    print(f"Saving CSV files (Found {interaction_count} interactions)...")
+
+    for table, (filename, fields) in OUTPUT_FILES.items():
+        if filename in checkpoint["generated"]:
+            continue
+        with perf.span("merge", file=filename) as s:
+            with open(filename, mode="w", newline="", encoding="utf-8") as file:
+                writer = csv.DictWriter(file, fieldnames=fields)
+                writer.writeheader()
+                for name, (_, tables) in COLLECTIONS.items():
+                    if table not in tables:
+                        continue
+                    for index in range(checkpoint["collections"][name]["shards"]):
+                        shard = shard_path(checkpoint, table, name, index)
+                        with open(
+                            shard, mode="r", newline="", encoding="utf-8"
+                        ) as part:
+                            shutil.copyfileobj(part, file)
+            s.add(rows=checkpoint["rows"][table], nbytes=os.path.getsize(filename))
+        checkpoint["generated"].append(filename)
+        save_checkpoint(checkpoint)
         print(f" Generated: {filename}")
 
     # --- 5. BACKUP ---
     print(f"\n  Uploading backup to Bucket: {bucket_name}...")
     try:
-        for filename in files_uploaded:
-            blob = bucket.blob(f"backups/{filename}")
-            blob.upload_from_filename(filename)
+        for filename in checkpoint["generated"]:
+            if filename in checkpoint["uploaded"]:
+                continue
+            with perf.span("upload", file=filename, kind="backup") as s:
+                blob = bucket.blob(f"backups/{filename}")
+                blob.upload_from_filename(filename)
+                s.add(nbytes=os.path.getsize(filename))
+            checkpoint["uploaded"].append(filename)
+            save_checkpoint(checkpoint)
             print(f" Uploaded: backups/{filename}")
     except Exception as e:
         print(f"  Bucket Error: {e}")
+        print(f"  Re-run with run ID {run_id} to upload the remaining files.")
+        raise
+
+    checkpoint["status"] = "complete"
+    save_checkpoint(checkpoint)
+    os.remove(CURRENT_RUN_FILE)
+    # The checkpoint itself is kept so re-running this run ID stays a no-op.
+    shutil.rmtree(os.path.join(CHECKPOINT_DIR, run_id, "shards"), ignore_errors=True)
 
     print("\n ETL Pipeline Complete!")
 
 
 if __name__ == "__main__":
-    run_etl_pipeline()
+    # Usage: python etl_pipeline.py [run_id]  (or set RUN_ID)
+    with perf.profile("run_etl_pipeline"):
+        run_etl_pipeline(sys.argv[1] if len(sys.argv) > 1 else os.environ.get("RUN_ID"))
@@ -0,0 +1,309 @@
+"""Tests for the BigQuery loader state machine, using fake BigQuery / GCS clients."""
+
+import datetime
+import importlib.util
+import json
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("google.cloud.storage")
+from google.api_core import exceptions  # noqa: E402
+
+LOADER_DIR = os.path.join(os.path.dirname(__file__), "..", "bigquery_loader_function")
+sys.path.insert(0, LOADER_DIR)  # For its `import perf`
+spec = importlib.util.spec_from_file_location(
+    "bq_loader_main", os.path.join(LOADER_DIR, "main.py")
+)
+loader = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(loader)
+
+TABLE_ID = "proj.recipe_analytics.recipes"
+LOCATION = "asia-south1"  # A single region: jobs.get needs the location
+RECORD = "load_jobs/recipes.json"
+
+
+# --- FAKES ---
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def download_as_text(self):
+        if self.name not in self.bucket.objects:
+            raise exceptions.NotFound(self.name)
+        data, self.generation = self.bucket.objects[self.name]
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if self.bucket.races:
+            self.bucket.races -= 1
+            self.bucket.bump(self.name)  # Another instance wrote in between
+        current = self.bucket.objects.get(self.name, (None, 0))[1]
+        if if_generation_match is not None and current != if_generation_match:
+            raise exceptions.PreconditionFailed(self.name)
+        self.bucket.objects[self.name] = (data, current + 1)
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}  # name -> (data, generation)
+        self.races = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix):
+        return [
+            self.blob(name) for name in sorted(self.objects) if name.startswith(prefix)
+        ]
+
+    def bump(self, name):
+        data, generation = self.objects[name]
+        self.objects[name] = (data, generation + 1)
+
+
+class FakeStorage:
+    def __init__(self):
+        self.bucket_ = FakeBucket()
+
+    def bucket(self, name):
+        return self.bucket_
+
+
+class FakeJob:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.location = LOCATION
+        self.state = "RUNNING"
+        self.error_result = None
+        self.output_rows = None
+        self.created = datetime.datetime(2026, 1, 1)
+        self.ended = None
+
+    def finish(self, rows=None, error=None):
+        self.state = "DONE"
+        self.output_rows = rows
+        self.error_result = error
+        self.ended = self.created + datetime.timedelta(seconds=4)
+
+
+class FakeBigQuery:
+    def __init__(self):
+        self.jobs = {}
+        self.submitted = []
+
+    def load_table_from_uri(self, uri, table_id, job_id, job_config):
+        if job_id in self.jobs:
+            raise exceptions.Conflict(job_id)
+        self.jobs[job_id] = FakeJob(job_id)
+        self.submitted.append(job_id)
+        return self.jobs[job_id]
+
+    def get_job(self, job_id, location=None):
+        if job_id not in self.jobs or location != LOCATION:
+            raise exceptions.NotFound(job_id)
+        return self.jobs[job_id]
+
+    def get_dataset(self, dataset_id):
+        assert dataset_id == "proj.recipe_analytics"
+        return types.SimpleNamespace(location=LOCATION)
+
+
+# --- HELPERS ---
+
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setenv("GCP_PROJECT", "proj")
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    clock = {"now": 1_000_000.0}
+    monkeypatch.setattr(loader.time, "time", lambda: clock["now"])
+    return FakeBigQuery(), FakeStorage(), clock
+
+
+def event(generation, name="backups/recipe.csv"):
+    return {"name": name, "bucket": "bucket", "generation": str(generation)}
+
+
+def record(storage):
+    return json.loads(storage.bucket_.objects[RECORD][0])
+
+
+def poll(bq, storage):
+    body, status = loader.poll_load_jobs(None, client=bq, storage_client=storage)
+    assert status == 200
+    return json.loads(body)
+
+
+# --- TESTS ---
+
+
+def test_event_submits_job_and_records_it(env):
+    bq, storage, _ = env
+    loader.load_to_bigquery(event(1), None, client=bq, storage_client=storage)
+
+    assert bq.submitted == ["load_recipes_1_1"]
+    rec = record(storage)
+    assert rec["state"] == "running"
+    assert rec["table_id"] == TABLE_ID
+    assert rec["source"] == {"uri": "gs://bucket/backups/recipe.csv", "generation": "1"}
+
+
+def test_non_backup_files_are_skipped(env):
+    bq, storage, _ = env
+    loader.load_to_bigquery(
+        event(1, name="etl_runs/x/checkpoint.json"), None, bq, storage
+    )
+    assert bq.submitted == []
+    assert storage.bucket_.objects == {}
+
+
+def test_duplicate_event_is_ignored(env):
+    bq, storage, _ = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+    loader.load_to_bigquery(event(1), None, bq, storage)
+    assert bq.submitted == ["load_recipes_1_1"]
+
+
+def test_events_during_a_load_coalesce_into_newest(env):
+    bq, storage, _ = env
+    for generation in (1, 2, 3, 2):
+        loader.load_to_bigquery(event(generation), None, bq, storage)
+
+    assert bq.submitted == ["load_recipes_1_1"]
+    assert record(storage)["queued"]["generation"] == "3"
+
+    bq.jobs["load_recipes_1_1"].finish(rows=10)
+    assert poll(bq, storage) == {"recipes": "running"}
+    assert bq.submitted == ["load_recipes_1_1", "load_recipes_3_1"]
+
+    bq.jobs["load_recipes_3_1"].finish(rows=12)
+    assert poll(bq, storage) == {"recipes": "done"}
+    assert record(storage)["output_rows"] == 12
+
+
+def test_running_job_is_left_alone(env):
+    bq, storage, _ = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+    assert poll(bq, storage) == {"recipes": "running"}
+    assert bq.submitted == ["load_recipes_1_1"]
+
+
+def test_failed_job_retries_with_backoff(env, monkeypatch):
+    monkeypatch.setattr(loader, "RETRY_BASE_SECONDS", 30)
+    bq, storage, clock = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+
+    bq.jobs["load_recipes_1_1"].finish(error={"reason": "backendError"})
+    assert poll(bq, storage) == {"recipes": "retry"}
+    assert record(storage)["next_attempt_at"] == clock["now"] + 30
+
+    clock["now"] += 29
+    assert poll(bq, storage) == {"recipes": "retry"}
+    clock["now"] += 1
+    assert poll(bq, storage) == {"recipes": "running"}
+    assert bq.submitted[-1] == "load_recipes_1_2"
+
+    bq.jobs["load_recipes_1_2"].finish(error={"reason": "backendError"})
+    poll(bq, storage)
+    assert record(storage)["next_attempt_at"] == clock["now"] + 60
+
+
+def test_gives_up_after_max_attempts(env, monkeypatch):
+    monkeypatch.setattr(loader, "MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(loader, "RETRY_BASE_SECONDS", 0)
+    bq, storage, _ = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+
+    bq.jobs["load_recipes_1_1"].finish(error={"reason": "invalid"})
+    assert poll(bq, storage) == {"recipes": "retry"}
+    assert poll(bq, storage) == {"recipes": "running"}
+    bq.jobs["load_recipes_1_2"].finish(error={"reason": "invalid"})
+    assert poll(bq, storage) == {"recipes": "failed"}
+    assert poll(bq, storage) == {"recipes": "failed"}
+    assert bq.submitted == ["load_recipes_1_1", "load_recipes_1_2"]
+
+
+def test_file_queued_during_retry_is_loaded(env):
+    bq, storage, _ = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+    bq.jobs["load_recipes_1_1"].finish(error={"reason": "backendError"})
+    assert poll(bq, storage) == {"recipes": "retry"}
+
+    loader.load_to_bigquery(event(2), None, bq, storage)
+    assert record(storage)["queued"]["generation"] == "2"
+
+    # The newer file starts straight away instead of waiting out the backoff
+    assert poll(bq, storage) == {"recipes": "running"}
+    assert bq.submitted[-1] == "load_recipes_2_1"
+
+    bq.jobs["load_recipes_2_1"].finish(rows=5)
+    assert poll(bq, storage) == {"recipes": "done"}
+    rec = record(storage)
+    assert rec["source"]["generation"] == "2"
+    assert rec["queued"] is None
+
+
+def test_unsubmitted_job_is_retried_after_grace_period(env):
+    bq, storage, clock = env
+
+    class FailingBigQuery(FakeBigQuery):
+        def load_table_from_uri(self, *args, **kwargs):
+            raise exceptions.ServiceUnavailable("down")
+
+    loader.load_to_bigquery(event(1), None, FailingBigQuery(), storage)
+    assert record(storage)["state"] == "running"
+
+    assert poll(bq, storage) == {"recipes": "running"}  # Within the grace period
+    clock["now"] += loader.SUBMIT_GRACE_SECONDS
+    assert poll(bq, storage) == {"recipes": "retry"}
+
+
+def test_record_update_retries_on_precondition_race(env):
+    bq, storage, _ = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+
+    storage.bucket_.races = 1
+    loader.load_to_bigquery(event(2), None, bq, storage)
+    assert record(storage)["queued"]["generation"] == "2"
+
+
+def test_job_location_is_recorded_and_used_to_poll(env):
+    bq, storage, clock = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+    assert record(storage)["location"] == LOCATION
+
+    # Long past the grace period, a regional job is still found and confirmed
+    clock["now"] += loader.SUBMIT_GRACE_SECONDS * 10
+    bq.jobs["load_recipes_1_1"].finish(rows=3)
+    assert poll(bq, storage) == {"recipes": "done"}
+    assert bq.submitted == ["load_recipes_1_1"]
+
+
+def test_resubmitted_job_takes_location_from_dataset(env):
+    bq, storage, _ = env
+    job = bq.jobs["load_recipes_1_1"] = FakeJob("load_recipes_1_1")
+    loader.load_to_bigquery(event(1), None, bq, storage)  # Conflict
+
+    assert record(storage)["location"] == LOCATION
+    job.finish(rows=3)
+    assert poll(bq, storage) == {"recipes": "done"}
+
+
+def test_record_without_location_is_still_polled(env):
+    bq, storage, clock = env
+    loader.load_to_bigquery(event(1), None, bq, storage)
+    rec = record(storage)
+    del rec["location"]
+    storage.bucket_.objects[RECORD] = (json.dumps(rec), 99)
+
+    clock["now"] += loader.SUBMIT_GRACE_SECONDS * 10
+    bq.jobs["load_recipes_1_1"].finish(rows=3)
+    assert poll(bq, storage) == {"recipes": "done"}
@@ -0,0 +1,404 @@
+"""Tests for the checkpointed ETL Cloud Function, using fake Firestore / GCS clients."""
+
+import csv
+import importlib.util
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("functions_framework")
+pytest.importorskip("google.cloud.firestore")
+pytest.importorskip("google.cloud.storage")
+
+FUNCTION_DIR = os.path.join(os.path.dirname(__file__), "..", "cloud_function")
+sys.path.insert(0, FUNCTION_DIR)  # For its `import perf`
+spec = importlib.util.spec_from_file_location(
+    "etl_function_main", os.path.join(FUNCTION_DIR, "main.py")
+)
+etl = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(etl)
+
+
+# --- FAKES ---
+
+
+class FakeDoc:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeDocRef:
+    def __init__(self, doc_id):
+        self.id = doc_id
+
+
+class FakeQuery:
+    def __init__(self, db, name, limit=None, after=None):
+        self.db = db
+        self.name = name
+        self._limit = limit
+        self.after = after
+
+    def order_by(self, field):
+        return self
+
+    def limit(self, n):
+        return FakeQuery(self.db, self.name, n, self.after)
+
+    def start_after(self, values):
+        return FakeQuery(self.db, self.name, self._limit, values["__name__"].id)
+
+    def document(self, doc_id):
+        return FakeDocRef(doc_id)
+
+    def stream(self):
+        self.db.pages += 1
+        if self.db.clock is not None:
+            self.db.clock.tick()
+        if self.db.pages == self.db.fail_on_page:
+            raise RuntimeError("Firestore unavailable")
+        docs = self.db.data.get(self.name, {})
+        ids = sorted(i for i in docs if self.after is None or i > self.after)
+        ids = ids[: self._limit]
+        self.db.reads[self.name] = self.db.reads.get(self.name, 0) + len(ids)
+        return iter([FakeDoc(i, docs[i]) for i in ids])
+
+
+class FakeFirestore:
+    def __init__(self, data, clock=None):
+        self.data = data
+        self.reads = {}  # collection -> docs read
+        self.pages = 0
+        self.fail_on_page = None
+        self.clock = clock  # Advanced one second per page read
+
+    def collection(self, name):
+        return FakeQuery(self, name)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+
+    @property
+    def size(self):
+        return len(self.bucket.objects[self.name])
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def download_as_text(self):
+        return self.bucket.objects[self.name].decode("utf-8")
+
+    def upload_from_string(self, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket.objects[self.name] = data
+
+    def compose(self, sources):
+        assert len(sources) <= etl.COMPOSE_LIMIT
+        self.bucket.composes.append(len(sources))
+        self.bucket.objects[self.name] = b"".join(
+            self.bucket.objects[s.name] for s in sources
+        )
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}  # name -> bytes
+        self.composes = []  # Source count of each compose request
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix):
+        return [
+            self.blob(name) for name in sorted(self.objects) if name.startswith(prefix)
+        ]
+
+
+class FakeStorage:
+    def __init__(self):
+        self.bucket_ = FakeBucket()
+
+    def bucket(self, name):
+        return self.bucket_
+
+
+class FakeClock:
+    """Stands in for the `time` module: one second passes per page read."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.lock = threading.Lock()
+
+    def tick(self, seconds=1):
+        with self.lock:
+            self.now += seconds
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.tick(seconds)
+
+
+class FakeRequest:
+    def __init__(self, args=None, body=None):
+        self.args = args or {}
+        self.body = body
+
+    def get_json(self, silent=False):
+        return self.body
+
+
+# --- HELPERS ---
+
+
+def dataset(n_users=3, n_recipes=2, n_interactions=1):
+    return {
+        "users": {
+            f"u{i:04d}": {"user_id": f"u{i}", "username": f"user{i}"}
+            for i in range(n_users)
+        },
+        "recipes": {
+            f"r{i:04d}": {
+                "recipe_id": f"r{i}",
+                "title": f"Recipe {i}",
+                "ingredients": [{"name": "salt", "quantity": 1, "unit": "g"}],
+                "steps": ["Mix", "Bake"],
+            }
+            for i in range(n_recipes)
+        },
+        "interactions": {
+            f"i{i:04d}": {"interaction_id": f"i{i}", "type": "view"}
+            for i in range(n_interactions)
+        },
+    }
+
+
+def target(**config):
+    return etl.make_target({"project": "proj", "prefix": "", **config}, "bucket")
+
+
+def run(db, storage, tgt, run_id=None, deadline=None):
+    bucket = storage.bucket(tgt["bucket"])
+    checkpoint = etl.resolve_checkpoint(bucket, tgt, run_id)
+    return etl.run_target(db, bucket, tgt, checkpoint, deadline)
+
+
+def read_csv(storage, name):
+    text = storage.bucket_.objects[name].decode("utf-8")
+    return list(csv.reader(io.StringIO(text)))
+
+
+# --- CHECKPOINTS ---
+
+
+def test_run_writes_every_backup(monkeypatch):
+    monkeypatch.setattr(etl, "CHECKPOINT_EVERY_PAGES", 1)
+    db, storage = FakeFirestore(dataset()), FakeStorage()
+
+    checkpoint = run(db, storage, target(page_size=2))
+
+    assert checkpoint["status"] == "complete"
+    assert checkpoint["rows"] == {
+        "users": 3,
+        "recipes": 2,
+        "ingredients": 2,
+        "steps": 4,
+        "interactions": 1,
+    }
+    names = sorted(storage.bucket_.objects)
+    assert [n for n in names if n.startswith("backups/")] == [
+        "backups/ingredients.csv",
+        "backups/interactions.csv",
+        "backups/recipe.csv",
+        "backups/steps.csv",
+        "backups/users.csv",
+    ]
+    # Shards and the current-run pointer are cleaned up; the checkpoint is kept
+    assert [n for n in names if n.startswith("etl_runs/")] == [
+        f"etl_runs/{checkpoint['run_id']}/checkpoint.json"
+    ]
+
+
+def test_resume_after_failed_page_reads_only_remaining_pages(monkeypatch):
+    monkeypatch.setattr(etl, "CHECKPOINT_EVERY_PAGES", 1)
+    db, storage = FakeFirestore(dataset(n_users=10)), FakeStorage()
+    db.fail_on_page = 3  # The third users page fails
+    tgt = target(page_size=2)
+
+    with pytest.raises(RuntimeError):
+        run(db, storage, tgt)
+    assert db.reads == {"users": 4}
+
+    db.fail_on_page = None
+    db.reads = {}
+    checkpoint = run(db, storage, tgt)  # Picks up the unfinished run
+
+    assert checkpoint["status"] == "complete"
+    assert db.reads["users"] == 6
+    rows = read_csv(storage, "backups/users.csv")
+    assert [row[0] for row in rows] == ["user_id"] + [f"u{i}" for i in range(10)]
+
+
+def test_rerunning_finished_run_makes_no_reads(monkeypatch):
+    db, storage = FakeFirestore(dataset()), FakeStorage()
+    checkpoint = run(db, storage, target())
+
+    clients = []
+    monkeypatch.setattr(etl.storage, "Client", lambda: storage)
+    monkeypatch.setattr(
+        etl.firestore, "Client", lambda **kwargs: clients.append(kwargs) or db
+    )
+    db.reads = {}
+    request = FakeRequest(args={"run_id": checkpoint["run_id"]})
+    body, status = etl.run_pipeline(request, "bucket", "proj")
+
+    assert status == 200
+    assert body == f"Run {checkpoint['run_id']} already complete (2 recipes)."
+    assert clients == []
+    assert db.reads == {}
+
+
+def test_compose_builds_csv_from_more_shards_than_one_request_takes(monkeypatch):
+    monkeypatch.setattr(etl, "CHECKPOINT_EVERY_PAGES", 1)
+    db, storage = FakeFirestore(dataset(n_users=40)), FakeStorage()
+
+    run(db, storage, target(page_size=1))
+
+    rows = read_csv(storage, "backups/users.csv")
+    assert rows[0] == etl.OUTPUT_FILES["users"][1]
+    assert [row[0] for row in rows[1:]] == [f"u{i}" for i in range(40)]
+    assert max(storage.bucket_.composes) == etl.COMPOSE_LIMIT
+    assert not any("_compose" in name for name in storage.bucket_.objects)
+
+
+def test_deadline_pauses_run_and_next_call_continues(monkeypatch):
+    monkeypatch.setattr(etl, "CHECKPOINT_EVERY_PAGES", 20)
+    db, storage = FakeFirestore(dataset(n_users=10)), FakeStorage()
+    tgt = target(page_size=2)
+
+    checkpoint = run(db, storage, tgt, deadline=time.monotonic())  # Already passed
+    assert checkpoint["status"] == "running"
+    assert checkpoint["collections"]["users"]["docs"] == 2  # One page, then pause
+
+    checkpoint = run(db, storage, tgt, checkpoint["run_id"])
+    assert checkpoint["status"] == "complete"
+    assert db.reads["users"] == 10
+
+
+# --- FAN-OUT ---
+
+
+def test_make_target_defaults_prefix_to_project_and_database():
+    tgt = etl.make_target({"project": "p", "database": "eu"}, "bucket")
+    assert tgt["prefix"] == "p/eu"
+    assert tgt["name"] == "bucket/p/eu"
+
+
+@pytest.mark.parametrize(
+    "prefix", ["backups", "backups/acme", "/backups/acme/", "etl_runs/x", "load_jobs"]
+)
+def test_make_target_rejects_reserved_prefixes(prefix):
+    with pytest.raises(ValueError):
+        etl.make_target({"project": "p", "prefix": prefix}, "bucket")
+
+
+def test_make_target_allows_reserved_names_below_top_level():
+    tgt = etl.make_target({"project": "p", "prefix": "acme/backups"}, "bucket")
+    assert etl.target_path(tgt, etl.BACKUP_PREFIX, "users.csv") == (
+        "acme/backups/backups/users.csv"
+    )
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        None,
+        {},
+        [{"project": "p"}],
+        "p",
+        {"targets": ["p"]},
+        {"targets": {"project": "p"}},
+        {"targets": [{}]},
+        {"targets": [{"database": "eu"}]},
+        {"targets": [{"project": "p", "prefix": ""}]},
+        {"targets": [{"project": "p", "prefix": "backups/acme"}]},
+        {"targets": [{"project": "p", "page_size": 0}]},
+        {"targets": [{"project": "p", "page_size": "many"}]},
+        {"targets": [{"project": "p", "reads_per_second": "x"}]},
+        {"targets": [{"project": "p", "reads_per_second": -1}]},
+        {"targets": [{"project": "p"}, {"project": "p", "prefix": "p/recipe"}]},
+        {"targets": [{"project": "p"}], "max_workers": 0},
+        {"targets": [{"project": "p"}], "max_workers": "two"},
+        {"targets": [{"project": "p"}], "slice_seconds": 1},
+        {"targets": [{"project": "p"}], "slice_seconds": None},
+    ],
+)
+def test_fanout_rejects_bad_input(monkeypatch, body):
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    monkeypatch.setattr(etl, "run_fanout", lambda *args: pytest.fail("ran"))
+
+    message, status = etl.run_etl_fanout(FakeRequest(body=body))
+
+    assert status == 400
+    assert message.startswith("Error:")
+
+
+def test_large_tenant_is_requeued_and_finishes_after_small_ones(monkeypatch):
+    monkeypatch.setattr(etl, "CHECKPOINT_EVERY_PAGES", 1)
+    clock = FakeClock()
+    monkeypatch.setattr(etl, "time", clock)
+    databases = {
+        "huge": FakeFirestore(dataset(n_users=40, n_recipes=40), clock),
+        "a": FakeFirestore(dataset(), clock),
+        "b": FakeFirestore(dataset(), clock),
+    }
+    clients = []
+
+    def connect(project, database):
+        clients.append(database)
+        return databases[database]
+
+    monkeypatch.setattr(etl.firestore, "Client", connect)
+    slices = []
+    run_slice = etl.run_slice
+
+    def counting_slice(target, *args):
+        slices.append(target["database"])
+        return run_slice(target, *args)
+
+    monkeypatch.setattr(etl, "run_slice", counting_slice)
+    storage = FakeStorage()
+    targets = [
+        etl.make_target({"project": "p", "database": name, "page_size": size}, "b")
+        for name, size in (("huge", 2), ("a", 10), ("b", 10))
+    ]
+
+    results = etl.run_fanout(
+        targets, max_workers=1, slice_seconds=5, storage_client=storage
+    )
+
+    assert list(results) == ["b/p/a", "b/p/b", "b/p/huge"]
+    assert slices[:3] == ["huge", "a", "b"]
+    assert slices.count("huge") > 2  # Requeued behind the small tenants
+    assert all(result["status"] == "complete" for result in results.values())
+    assert results["b/p/huge"]["recipes"] == 40
+    assert sorted(clients) == ["a", "b", "huge"]  # One client per database
+    rows = read_csv(storage, "p/huge/backups/users.csv")
+    assert [row[0] for row in rows[1:]] == [f"u{i}" for i in range(40)]
@@ -0,0 +1,100 @@
+"""Tests for the perf helper copied into every deployable folder."""
+
+import importlib.util
+import json
+import os
+import threading
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+COPIES = ["cloud_function/perf.py", "bigquery_loader_function/perf.py", "src/perf.py"]
+
+spec = importlib.util.spec_from_file_location(
+    "perf_under_test", os.path.join(ROOT, COPIES[0])
+)
+perf = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(perf)
+
+
+def read(path):
+    with open(os.path.join(ROOT, path), mode="rb") as f:
+        return f.read()
+
+
+def records(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_copies_are_identical():
+    # Cloud Functions upload one folder at a time, so perf.py is copied;
+    # edit cloud_function/perf.py and copy it over the others.
+    original = read(COPIES[0])
+    for path in COPIES[1:]:
+        assert read(path) == original, f"{path} differs from {COPIES[0]}"
+
+
+@pytest.mark.parametrize(
+    "value, expected", [("", 10.0), ("2.5", 2.5), ("abc", 10.0), ("0", 10.0)]
+)
+def test_profile_interval_is_parsed_when_profiling(
+    monkeypatch, capsys, value, expected
+):
+    monkeypatch.setattr(perf, "PROFILE_ENABLED", True)
+    monkeypatch.setenv("ETL_PROFILE_INTERVAL_MS", value)
+
+    with perf.profile("test"):
+        pass
+
+    profile = records(capsys)[-1]
+    assert profile["stage"] == "profile"
+    assert profile["interval_ms"] == expected
+
+
+def test_profile_samples_only_registered_busy_threads(monkeypatch, capsys):
+    monkeypatch.setattr(perf, "PROFILE_ENABLED", True)
+    monkeypatch.setenv("ETL_PROFILE_INTERVAL_MS", "1")
+    stop = threading.Event()
+
+    def spin():
+        while not stop.is_set():
+            pass
+
+    def worker():
+        with perf.sampled_thread():
+            spin()
+
+    def unregistered_spin():
+        while not stop.is_set():
+            pass
+
+    unregistered = threading.Thread(target=unregistered_spin)
+    registered = threading.Thread(target=worker)
+    unregistered.start()
+    try:
+        with perf.profile("test"):
+            registered.start()
+            stop.wait(0.2)  # The profiled thread itself only waits
+            stop.set()
+            registered.join()
+    finally:
+        stop.set()
+        unregistered.join()
+
+    frames = [f["frame"] for f in records(capsys)[-1]["hot_frames"]]
+    assert frames[0].startswith("test_perf.py:spin")
+    assert not any("unregistered_spin" in frame for frame in frames)
+    assert not any("threading.py" in frame for frame in frames)
+
+
+def test_span_emits_error_status(capsys):
+    with pytest.raises(ValueError):
+        with perf.span("extract", collection="users"):
+            raise ValueError("boom")
+
+    record = records(capsys)[-1]
+    assert record["stage"] == "extract"
+    assert record["status"] == "error"
+    assert record["severity"] == "ERROR"
+    assert record["error"] == "boom"
+    assert record["collection"] == "users"